@@ -1,5 +1,5 @@
-import argparse, base64, io, json, math, os, sys
-import PIL.Image
+import argparse, array, base64, hashlib, io, json, math, mmap, os, struct, sys, time
+import PIL.Image, PIL.ImageChops, PIL.ImageColor, PIL.PngImagePlugin
 
 RECT_NONE           = 'none'
 RECT_FILL           = 'fill'
@@ -36,7 +36,16 @@ FMT_SVG             = 'svg'
 FMT_PDF             = 'pdf'
 FMT_PNG             = 'png'
 FMT_GIF_ANIM        = 'gif-anim'
-FMT_LIST            = [FMT_SVG, FMT_PDF, FMT_PNG, FMT_GIF_ANIM]
+FMT_APNG            = 'apng'
+FMT_WEBP_ANIM       = 'webp-anim'
+FMT_LVLB            = 'lvlb'
+FMT_THUMB           = 'thumb'
+FMT_LIST            = [FMT_SVG, FMT_PDF, FMT_PNG, FMT_GIF_ANIM, FMT_APNG, FMT_WEBP_ANIM, FMT_LVLB, FMT_THUMB]
+FMT_ANIM_LIST       = [FMT_GIF_ANIM, FMT_APNG, FMT_WEBP_ANIM]
+FMT_RASTER_LIST     = [FMT_PNG] + FMT_ANIM_LIST
+
+LVLB_MAGIC          = b'LVLB'
+LVLB_VERSION        = 2
 
 class GroupShapeStyleAction(argparse.Action):
     def __init__(self, option_strings, dest, nargs=None, **kwargs):
@@ -67,7 +76,7 @@ class CustomHelpFormatter(argparse.HelpFormatter):
             return super()._format_args(action, default_metavar)
 
 parser = argparse.ArgumentParser(description='Create image from level file.', formatter_class=CustomHelpFormatter)
-parser.add_argument('levelfiles', type=str, nargs='+', help='Input level files.')
+parser.add_argument('levelfiles', type=str, nargs='+', help='Input level files, or folders of level files; binary level files can select frames with FILE#INDEX or FILE#START:STOP.')
 parser.add_argument('--outfolder', type=str, help='Output folder.')
 
 group = parser.add_mutually_exclusive_group(required=False)
@@ -85,7 +94,7 @@ parser.add_argument('--font-yadjust', type=float, help='Amount to adjust y posit
 parser.add_argument('--cell-size', type=int, help='Cell size.', default=11)
 parser.add_argument('--cfgfile', type=str, help='Config file.')
 parser.add_argument('--suffix', type=str, help='Extra suffix to add to output file.', default='.out')
-parser.add_argument('--fmt', type=str, choices=FMT_LIST, help='Output format, from: ' + ','.join(FMT_LIST) + '.', default=FMT_PDF)
+parser.add_argument('--fmt', type=str, choices=FMT_LIST, action='append', help='Output format, from: ' + ','.join(FMT_LIST) + '; repeat for several formats from one pass; default ' + FMT_PDF + '; ' + FMT_LVLB + ' packs all levels into one binary level file; ' + FMT_THUMB + ' makes small color block previews.')
 parser.add_argument('--stdout', action='store_true', help='Write to stdout instead of file.')
 parser.add_argument('--viz', type=str, nargs='+', action=GroupShapeStyleAction, help='How to display the group GROUP; SHAPE from: ' + ','.join(SHAPE_LIST) + '; STYLE from: ' + ','.join(PATH_LIST) + ' or ' + ','.join(RECT_LIST) + '.')
 parser.add_argument('--viz-hide', type=str, metavar='GROUP', action='append', help='Hide a group.')
@@ -97,18 +106,42 @@ parser.add_argument('--tile-text', action='store_true', help='Always show tile t
 parser.add_argument('--tile-norect', action='store_true', help='No rectangle with tile text.')
 parser.add_argument('--padding', type=int, help='Padding around edges.', default=0)
 parser.add_argument('--anim-delay', type=int, help='Frame delay for animation (in ms).', default=250)
+parser.add_argument('--anim-compress', type=int, choices=range(10), metavar='LEVEL', help='Lossless compression level for apng and webp-anim, from 0 (fastest) to 9 (smallest); webp-anim uses at most 6.', default=6)
 parser.add_argument('--raster-scale', type=int, help='Amount to scale raster images by.', default=2)
+parser.add_argument('--glyph-cache', action='store_true', help='For raster output, blit pre-rasterized tile text instead of converting it with the rest of the image; faster, but pixels may differ slightly.')
+parser.add_argument('--glyph-cache-folder', type=str, help='Folder to save pre-rasterized tile text in and load it from; implies --glyph-cache.')
 
 # Arguments for multiple levels in one image.
 parser.add_argument('--montage', type=int, nargs=4, metavar=('MAX_X', 'MAX_Y', 'PAD_X', 'PAD_Y'), help='Put multiple levels in one image; MAX_X: number of levels per row or -1 for unlimited; MAX_Y: number of levels per column or -1 for unlimited; PAD_X: padding between levels on each row; PAD_Y: padding between levels on each column.')
 
+# Arguments for rendering part of each level.
+group = parser.add_mutually_exclusive_group(required=False)
+group.add_argument('--region', type=int, nargs=4, metavar=('R0', 'C0', 'R1', 'C1'), help='Only render cells from row R0 and column C0 up to but not including row R1 and column C1.')
+group.add_argument('--region-group', type=str, nargs=3, metavar=('GROUP', 'ROWS', 'COLS'), help='Only render a window of ROWS by COLS cells centered on the last point of group GROUP, kept inside the level.')
+
+# Arguments for thumbnails.
+parser.add_argument('--thumb-scale', type=int, help='Pixels per cell for thumbnails.', default=2)
+parser.add_argument('--thumb-overlay', action='store_true', help='Show tile and path groups as single pixels in thumbnails.')
+
+# Arguments for aggregating many levels into one heatmap.
+parser.add_argument('--heatmap', type=str, nargs='+', metavar='GROUP', help='Count cell visits and path/line edge traversals of groups GROUP over all levels and draw them as a heatmap on one reference level; cell visits come from a group\'s tiles, or from its path and line points if it has no tiles.')
+parser.add_argument('--heatmap-reference', type=str, help='Level to draw the heatmap on; defaults to the first level.')
+
+# Arguments for re-rendering levels as they change.
+parser.add_argument('--watch', action='store_true', help='Keep running and re-render levels that are changed or added.')
+parser.add_argument('--watch-interval', type=float, help='Seconds between checks for changes when watching; files must be unchanged for one interval before rendering.', default=1.0)
+
 group = parser.add_mutually_exclusive_group(required=False)
 group.add_argument('--cairosvg', action='store_true', help='Only try to use cairosvg converter.')
 group.add_argument('--svglib', action='store_true', help='Only try to use svglib converter.')
 
 args = parser.parse_args()
 
-if args.stdout and args.fmt != FMT_SVG:
+if args.fmt is None:
+    args.fmt = [FMT_PDF]
+args.fmt = list(dict.fromkeys(args.fmt))
+
+if args.stdout and args.fmt != [FMT_SVG]:
     raise RuntimeError('can only write svg to stdout')
 
 if args.cfgfile is None:
@@ -117,8 +150,30 @@ if args.cfgfile is None:
 with open(args.cfgfile, 'rt') as cfgfile:
     cfg = json.load(cfgfile)
 
-if args.background_files is not None and len(args.background_files) != len(args.levelfiles):
-    raise RuntimeError('must have same number of levels and backgrounds')
+if FMT_LVLB in args.fmt and args.montage is not None:
+    raise RuntimeError('can\'t use montage with %s' % FMT_LVLB)
+
+if args.heatmap is not None and (any(fmt not in [FMT_SVG, FMT_PDF, FMT_PNG] for fmt in args.fmt) or args.montage is not None):
+    raise RuntimeError('heatmap can only be used with svg, pdf, or png and no montage')
+
+if args.region is not None or args.region_group is not None:
+    if FMT_LVLB in args.fmt or FMT_THUMB in args.fmt or args.heatmap is not None:
+        raise RuntimeError('can\'t use region with %s, %s, or heatmap' % (FMT_LVLB, FMT_THUMB))
+    if args.region is not None and (args.region[2] <= args.region[0] or args.region[3] <= args.region[1]):
+        raise RuntimeError('region must have R1 greater than R0 and C1 greater than C0')
+    if args.region_group is not None:
+        if not args.region_group[1].isdigit() or not args.region_group[2].isdigit() or int(args.region_group[1]) <= 0 or int(args.region_group[2]) <= 0:
+            parser.error('argument --region-group: ROWS and COLS must be positive integers')
+        args.region_group = (args.region_group[0], int(args.region_group[1]), int(args.region_group[2]))
+
+if args.watch and args.stdout:
+    raise RuntimeError('can\'t watch when writing to stdout')
+
+if args.background_files is not None:
+    if len(args.background_files) != len(args.levelfiles):
+        raise RuntimeError('must have same number of levels and backgrounds')
+    if any(os.path.isdir(levelfile) or '.lvlb' in levelfile for levelfile in args.levelfiles):
+        raise RuntimeError('can\'t use folders or binary level files with background files')
 
 
 
@@ -130,6 +185,34 @@ def is_between(ra, ca, rb, cb, rc, cc):
         return False
     return abs(distance(ra, ca, rb, cb) + distance(rb, cb, rc, cc) - distance(ra, ca, rc, cc)) < 0.01
 
+def quad_point(x1, y1, cx, cy, x2, y2, t):
+    return (1 - t)**2 * x1 + 2 * (1 - t) * t * cx + t**2 * x2, (1 - t)**2 * y1 + 2 * (1 - t) * t * cy + t**2 * y2
+
+def in_clip(clip, x, y):
+    return clip[0] <= x <= clip[2] and clip[1] <= y <= clip[3]
+
+def clip_curve(x1, y1, cx, cy, x2, y2, clip):
+    # range of t where a quadratic curve is inside clip, found by sampling about once per unit then refining the ends;
+    # assumes the inside part is one piece
+    steps = max(16, int(distance(x1, y1, x2, y2)))
+    inside = [ii for ii in range(steps + 1) if in_clip(clip, *quad_point(x1, y1, cx, cy, x2, y2, ii / steps))]
+    if len(inside) == 0:
+        return None
+
+    ends = []
+    for ii, jj in [(inside[0], inside[0] - 1), (inside[-1], inside[-1] + 1)]:
+        t_in = ii / steps
+        if 0 <= jj <= steps:
+            t_out = jj / steps
+            for kk in range(20):
+                t_mid = (t_in + t_out) / 2
+                if in_clip(clip, *quad_point(x1, y1, cx, cy, x2, y2, t_mid)):
+                    t_in = t_mid
+                else:
+                    t_out = t_mid
+        ends.append(t_in)
+    return ends
+
 def svg_rect(r0, c0, rsz, csz, xoff, yoff, sides, style, color, drawn):
     if (rsz, csz) == (0, 0):
         print(' - WARNING: skipping zero-size rect: %f %f %f %f' % (r0, c0, rsz, csz))
@@ -199,12 +282,110 @@ def svg_rect(r0, c0, rsz, csz, xoff, yoff, sides, style, color, drawn):
             raise RuntimeError('can\'t use sides with style: %s' % style)
         return '  <rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" style="%s"/>\n' % (x0, y0, xsz, ysz, style_svg)
 
-def svg_line(r1, c1, r2, c2, xoff, yoff, color, require_arc, arc_avoid_edges, from_circle, to_circle, to_arrow, to_point, dash, thick):
+def path_edges(points):
+    solitary_points = []
+    edges = []
+
+    prev_point_connected = False
+    prev_point = None
+    for point in points:
+        if point is None or len(point) == 0:
+            if prev_point is not None and not prev_point_connected:
+                solitary_points.append(prev_point)
+            prev_point_connected = False
+            prev_point = None
+        elif len(point) == 2:
+            if prev_point is not None:
+                edges.append([prev_point[0], prev_point[1], point[0], point[1]])
+            prev_point_connected = prev_point is not None
+            prev_point = point
+        elif len(point) == 4:
+            edges.append(point)
+            prev_point_connected = True
+            prev_point = [point[-2], point[-1]]
+        elif len(point) == 6:
+            fr, fc, tr, tc, pwtr, pwtc = point
+            edges.append([fr, fc, pwtr, pwtc])
+            edges.append([tr - (pwtr - fr), tc - (pwtc - fc), tr, tc])
+            prev_point_connected = True
+            prev_point = [tr, tc]
+        else:
+            raise RuntimeError('unknown point type: %s' % str(point))
+
+    if prev_point is not None and not prev_point_connected:
+        solitary_points.append(prev_point)
+
+    return edges, solitary_points
+
+def path_points(edges):
+    # cells visited along edges, not counting an edge's start again when it is where the previous edge ended
+    points = []
+    prev_point = None
+    for r1, c1, r2, c2 in edges:
+        if prev_point != [r1, c1]:
+            points.append([r1, c1])
+        points.append([r2, c2])
+        prev_point = [r2, c2]
+    return points
+
+def svg_heatmap(heatmap, xoff, yoff):
+    cell_counts, edge_counts, color = heatmap
+
+    ret = ''
+    if cell_counts.size > 0 and cell_counts.max() > 0:
+        max_count = cell_counts.max()
+        for rr, cc in numpy.argwhere(cell_counts > 0).tolist():
+            ret += '  <rect x="%.2f" y="%.2f" width="%.2f" height="%.2f" style="stroke:none;fill:%s;fill-opacity:%.2f"/>\n' % (cc * args.cell_size + xoff, rr * args.cell_size + yoff, args.cell_size, args.cell_size, color, 0.1 + 0.7 * cell_counts[rr, cc] / max_count)
+
+    if len(edge_counts) > 0:
+        max_count = max(edge_counts.values())
+        for (r1, c1, r2, c2), count in edge_counts.items():
+            x1 = (c1 + 0.5) * args.cell_size + xoff
+            y1 = (r1 + 0.5) * args.cell_size + yoff
+            x2 = (c2 + 0.5) * args.cell_size + xoff
+            y2 = (r2 + 0.5) * args.cell_size + yoff
+            ret += '  <line x1="%.2f" y1="%.2f" x2="%.2f" y2="%.2f" stroke="%s" stroke-width="%.2f" stroke-opacity="%.2f" stroke-linecap="round"/>\n' % (x1, y1, x2, y2, color, 0.5 + 2.5 * count / max_count, 0.2 + 0.8 * count / max_count)
+
+    return ret
+
+def svg_tile_text(char, clr, x, y):
+    custom = None
+    if char == '<':
+        char = '&lt;'
+    elif char == '>':
+        char = '&gt;'
+    elif char == '&':
+        char = '&#38;'
+    elif char in '─│┐┘└┌':
+        pth = {'─': (0.0, 0.5, 1.0, 0.5), '│': (0.5, 0.0, 0.5, 1.0), '┐': (0.5, 1.0, 0.0, 0.5), '┘': (0.0, 0.5, 0.5, 0.0), '└': (0.5, 0.0, 1.0, 0.5), '┌': (1.0, 0.5, 0.5, 1.0)}[char]
+        gz = args.cell_size
+        yo = y - gz + 1
+        char = None
+        custom = '<path d="M %.2f %.2f L %.2f %.2f L %.2f %.2f" stroke="%s" stroke-width="1" stroke-linecap="round" fill="none"/>' % (x + gz * pth[0], yo + gz * pth[1], x + gz * 0.5, yo + gz * 0.5, x + gz * pth[2], yo + gz * pth[3], clr)
+
+    text_svg = ''
+    if custom is not None:
+        text_svg += '  ' + custom + '\n'
+    if char is not None:
+        xscale = 1.0 / len(char)
+        text_svg += '  <text x="%.2f" y="%.2f" transform="scale(%.2f, 1.0)" dominant-baseline="middle" text-anchor="middle" fill="%s" style="fill-opacity:%.2f">%s</text>\n' % ((x + 0.5 * args.cell_size) / xscale, y - (0.5 - args.font_yadjust) * args.cell_size, xscale, clr, 1.0, char)
+    if not args.tile_norect:
+        text_svg += '  <rect x="%d" y="%d" width="%d" height="%d" style="stroke:none;fill:%s;fill-opacity:%.2f"/>\n' % (x, y - args.cell_size + 1, args.cell_size, args.cell_size, clr, 0.3)
+    return text_svg
+
+def svg_line(r1, c1, r2, c2, xoff, yoff, color, require_arc, arc_avoid_edges, from_circle, to_circle, to_arrow, to_point, dash, thick, clip):
     x1 = (c1 + 0.5) * args.cell_size + xoff
     y1 = (r1 + 0.5) * args.cell_size + yoff
     x2 = (c2 + 0.5) * args.cell_size + xoff
     y2 = (r2 + 0.5) * args.cell_size + yoff
 
+    if clip is not None:
+        # ends cut off by the clip don't get their markers
+        from_circle = from_circle and in_clip(clip, x1, y1)
+        to_circle = to_circle and in_clip(clip, x2, y2)
+        to_arrow = to_arrow and in_clip(clip, x2, y2)
+        to_point = to_point and in_clip(clip, x2, y2)
+
     opts_shape = ''
     if thick:
         opts_shape += (' stroke="%s"' % color)
@@ -275,6 +456,21 @@ def svg_line(r1, c1, r2, c2, xoff, yoff, color, require_arc, arc_avoid_edges, fr
 
         ret += '  <g transform="translate(%.2f %.2f) rotate(%.2f)"><polygon points="0 0, -4 -2, -4 2" fill="%s"%s/></g>\n' % (x2, y2, rotate, color, opts_shape)
 
+    if clip is not None:
+        if not as_arc:
+            curvex, curvey = midx, midy
+        t_range = clip_curve(x1, y1, curvex, curvey, x2, y2, clip)
+        if t_range is None:
+            return ret
+        t0, t1 = t_range
+        if (t0, t1) != (0.0, 1.0):
+            # the part of the curve from t0 to t1 is itself a quadratic curve, with this control point
+            clipx1, clipy1 = quad_point(x1, y1, curvex, curvey, x2, y2, t0)
+            clipx2, clipy2 = quad_point(x1, y1, curvex, curvey, x2, y2, t1)
+            curvex = (1 - t0) * (1 - t1) * x1 + ((1 - t0) * t1 + t0 * (1 - t1)) * curvex + t0 * t1 * x2
+            curvey = (1 - t0) * (1 - t1) * y1 + ((1 - t0) * t1 + t0 * (1 - t1)) * curvey + t0 * t1 * y2
+            x1, y1, x2, y2 = clipx1, clipy1, clipx2, clipy2
+
     if as_arc:
         ret += '  <path d="M %.2f %.2f Q %.2f %.2f %.2f %.2f" stroke="%s" stroke-linecap="round" fill="none"%s/>\n' % (x1, y1, curvex, curvey, x2, y2, color, opts_line)
     else:
@@ -296,8 +492,341 @@ def b64_image(image):
     b64_data = base64.b64encode(byte_data.read()).decode('ascii')
     return b64_data
 
-def load_b64_image(filename):
-    return b64_image(load_image(filename))
+def load_region_image(filename, region, level_size):
+    image = load_image(filename)
+    grid_rows, grid_cols = level_size
+    if region is not None and grid_rows > 0 and grid_cols > 0:
+        r0, c0, r1, c1 = region
+        image = image.crop((c0 * image.width // grid_cols, r0 * image.height // grid_rows, c1 * image.width // grid_cols, r1 * image.height // grid_rows))
+    return image
+
+
+
+def group_center(draw_data, group):
+    center = None
+    for mgroup, mshape, mpoints in draw_data:
+        if mgroup != group:
+            continue
+        for point in mpoints:
+            if point is None or len(point) == 0:
+                continue
+            if mshape == SHAPE_RECT:
+                center = [(point[0] + point[2]) // 2, (point[1] + point[3]) // 2]
+            elif len(point) == 2:
+                center = point
+            else:
+                # lines, and path edges and portals, end at their third and fourth coordinates
+                center = point[2:4]
+    return center
+
+def level_region(draw_data, level_size):
+    grid_rows, grid_cols = level_size
+
+    if args.region is not None:
+        r0, c0, r1, c1 = args.region
+        r0, c0, r1, c1 = max(r0, 0), max(c0, 0), min(r1, grid_rows), min(c1, grid_cols)
+        if r1 <= r0 or c1 <= c0:
+            raise RuntimeError('region is outside level: %d %d %d %d' % tuple(args.region))
+        return r0, c0, r1, c1
+
+    if args.region_group is not None:
+        group, rows, cols = args.region_group
+        rows, cols = min(rows, grid_rows), min(cols, grid_cols)
+        center = group_center(draw_data, group)
+        if center is None:
+            print(' - WARNING: region group not found, centering on level: %s' % group)
+            center = [grid_rows // 2, grid_cols // 2]
+        r0 = min(max(int(center[0]) - rows // 2, 0), grid_rows - rows)
+        c0 = min(max(int(center[1]) - cols // 2, 0), grid_cols - cols)
+        return r0, c0, r0 + rows, c0 + cols
+
+    return None
+
+def crop_grid(grid, region, first_row):
+    r0, c0, r1, c1 = region
+    return [row[c0:c1] for row in grid[max(r0 - first_row, 0):max(r1 - first_row, 0)]]
+
+def region_has_cell(region, rr, cc):
+    if region is None:
+        return True
+    r0, c0, r1, c1 = region
+    return r0 <= rr < r1 and c0 <= cc < c1
+
+def region_has_edge(region, r1, c1, r2, c2):
+    if region is None:
+        return True
+    r0, c0, rn, cn = region
+    # edges run between cell centers and may arc up to a cell to the side, so keep any edge that comes that close
+    return max(r1, r2) >= r0 - 1 and min(r1, r2) < rn + 1 and max(c1, c2) >= c0 - 1 and min(c1, c2) < cn + 1
+
+def region_clip_rect(region, r1, c1, r2, c2):
+    if region is None:
+        return r1, c1, r2, c2
+    r0, c0, rn, cn = region
+    rlo, rhi = max(min(r1, r2), r0), min(max(r1, r2), rn)
+    clo, chi = max(min(c1, c2), c0), min(max(c1, c2), cn)
+    if rlo > rhi or clo > chi or (rlo == rhi and r1 != r2) or (clo == chi and c1 != c2):
+        return None
+    return rlo, clo, rhi, chi
+
+def split_level_frame(levelfile):
+    filename, sep, frame = levelfile.rpartition('#')
+    if sep == '' or not filename.endswith('.lvlb'):
+        return levelfile, None
+    return filename, int(frame)
+
+def load_level(levelfile):
+    layer_grids, draw_data, region, level_size = load_level_region(levelfile, False)
+    return layer_grids, draw_data
+
+def load_level_region(levelfile, crop):
+    # when cropping to a region, only the region's part of each grid is kept; the region and full level size are also returned
+    lvlb_filename, lvlb_frame = split_level_frame(levelfile)
+    if lvlb_frame is not None:
+        return read_level_bin_frame(open_level_bin(lvlb_filename), lvlb_frame, crop)
+
+    layer_grids = []
+    draw_data = []
+    grid_rows, grid_cols = 0, 0
+    first_row = 0
+
+    if levelfile.endswith('.json'):
+        with open(levelfile, 'rt') as lvl:
+            level_json = json.load(lvl)
+        for layer, grid in level_json.items():
+            layer_grids.append(grid)
+            grid_rows = max(grid_rows, len(grid))
+            grid_cols = max([grid_cols] + [len(row) for row in grid])
+
+    else:
+        # a fixed region is known before reading, so rows outside it don't need to be kept
+        last_row = None
+        if crop and args.region is not None:
+            first_row, last_row = max(args.region[0], 0), args.region[2]
+
+        with open(levelfile, 'rt') as lvl:
+            grid = []
+            for line in lvl:
+                line = line.rstrip('\n')
+
+                if line.startswith('META'):
+                    meta = json.loads(line[4:])
+                    if meta['type'] == 'geom':
+                        if meta['shape'] in SHAPE_LIST:
+                            draw_data.append((meta['group'], meta['shape'], meta['data']))
+                        else:
+                            print(' - WARNING: unrecognized META geom: %s' % line)
+
+                else:
+                    if last_row is None or first_row <= grid_rows < last_row:
+                        grid.append(line)
+                    grid_rows += 1
+                    grid_cols = max(grid_cols, len(line))
+            layer_grids.append(grid)
+
+    region = None
+    if crop:
+        region = level_region(draw_data, (grid_rows, grid_cols))
+    if region is not None:
+        layer_grids = [crop_grid(grid, region, first_row) for grid in layer_grids]
+
+    return layer_grids, draw_data, region, (grid_rows, grid_cols)
+
+def write_level_bin(filename, levels):
+    # index 0 is reserved for padding short rows
+    chars, char_index = [''], {}
+    groups, group_index = [], {}
+    for layer_grids, draw_data in levels:
+        for grid in layer_grids:
+            for row in grid:
+                for char in row:
+                    if char not in char_index:
+                        char_index[char] = len(chars)
+                        chars.append(char)
+        for group, shape, points in draw_data:
+            if group not in group_index:
+                group_index[group] = len(groups)
+                groups.append(group)
+
+    if len(chars) <= 0x100:
+        cell_width, cell_typecode = 1, 'B'
+    elif len(chars) <= 0xd800:
+        cell_width, cell_typecode = 2, 'H'
+    else:
+        raise RuntimeError('too many distinct tiles: %d' % len(chars))
+
+    frames = []
+    for layer_grids, draw_data in levels:
+        frame = bytearray(struct.pack('<HI', len(layer_grids), len(draw_data)))
+
+        for grid in layer_grids:
+            grid_cols = max([len(row) for row in grid], default=0)
+            cells = array.array(cell_typecode)
+            for row in grid:
+                cells.extend([char_index[char] for char in row])
+                cells.extend([0] * (grid_cols - len(row)))
+            if sys.byteorder == 'big':
+                cells.byteswap()
+            frame += struct.pack('<II', len(grid), grid_cols)
+            frame += cells.tobytes()
+
+        for group, shape, points in draw_data:
+            lengths = bytes([0 if point is None else len(point) for point in points])
+            coords = [coord for point in points if point is not None for coord in point]
+            typecode = 'i' if all(isinstance(coord, int) and -0x80000000 <= coord < 0x80000000 for coord in coords) else 'd'
+            coords = array.array(typecode, coords)
+            if sys.byteorder == 'big':
+                coords.byteswap()
+            frame += struct.pack('<IB1sII', group_index[group], SHAPE_LIST.index(shape), typecode.encode('ascii'), len(lengths), len(coords))
+            frame += lengths
+            frame += coords.tobytes()
+
+        frames.append(frame)
+
+    header = bytearray(struct.pack('<4sHBBIII', LVLB_MAGIC, LVLB_VERSION, cell_width, 0, len(frames), len(chars) - 1, len(groups)))
+    # tiles from json levels may be more than one character
+    for char in chars[1:]:
+        char_bytes = char.encode('utf-8')
+        header += struct.pack('<H', len(char_bytes)) + char_bytes
+    for group in groups:
+        group_bytes = group.encode('utf-8')
+        header += struct.pack('<H', len(group_bytes)) + group_bytes
+
+    # frame offset table allows random access by frame index
+    offset = len(header) + 8 * (len(frames) + 1)
+    for frame in frames:
+        header += struct.pack('<Q', offset)
+        offset += len(frame)
+    header += struct.pack('<Q', offset)
+
+    with open(filename, 'wb') as outfile:
+        outfile.write(header)
+        for frame in frames:
+            outfile.write(frame)
+
+level_bins = {}
+
+def open_level_bin(filename):
+    stat = os.stat(filename)
+    stat_key = (stat.st_mtime_ns, stat.st_size)
+    if filename in level_bins and level_bins[filename][0] == stat_key:
+        return level_bins[filename][1]
+
+    with open(filename, 'rb') as lvlb:
+        data = mmap.mmap(lvlb.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, cell_width, reserved, frame_count, char_count, group_count = struct.unpack_from('<4sHBBIII', data, 0)
+    if magic != LVLB_MAGIC:
+        raise RuntimeError('not a binary level file: %s' % filename)
+    if version != LVLB_VERSION:
+        raise RuntimeError('unsupported binary level file version: %d' % version)
+    pos = struct.calcsize('<4sHBBIII')
+
+    chars = ['']
+    for ii in range(char_count):
+        char_len = struct.unpack_from('<H', data, pos)[0]
+        chars.append(data[pos + 2:pos + 2 + char_len].decode('utf-8'))
+        pos += 2 + char_len
+
+    # decoding cells as latin-1 or utf-16 gives the char index as the code point, which translate maps back to the char;
+    # tiles that aren't single characters are looked up one cell at a time into a list instead
+    char_table = None
+    if all(len(char) == 1 for char in chars[1:]):
+        char_table = {ii: char for ii, char in enumerate(chars)}
+        char_table[0] = None
+
+    groups = []
+    for ii in range(group_count):
+        group_len = struct.unpack_from('<H', data, pos)[0]
+        groups.append(data[pos + 2:pos + 2 + group_len].decode('utf-8'))
+        pos += 2 + group_len
+
+    lvlbin = {'data': data, 'cell_width': cell_width, 'frame_count': frame_count, 'chars': chars, 'char_table': char_table, 'groups': groups, 'offsets_pos': pos}
+    level_bins[filename] = (stat_key, lvlbin)
+    return lvlbin
+
+def read_level_bin_frame(lvlbin, frame, crop):
+    data = lvlbin['data']
+    if frame < 0 or frame >= lvlbin['frame_count']:
+        raise RuntimeError('frame out of range: %d' % frame)
+
+    # only this frame's bytes are read from the mapped file
+    pos = struct.unpack_from('<Q', data, lvlbin['offsets_pos'] + 8 * frame)[0]
+
+    layer_count, geom_count = struct.unpack_from('<HI', data, pos)
+    pos += struct.calcsize('<HI')
+
+    cell_width = lvlbin['cell_width']
+    encoding = 'latin-1' if cell_width == 1 else 'utf-16-le'
+
+    # grids are only decoded after the geoms are read, since a region may be centered on a group
+    layers = []
+    for ii in range(layer_count):
+        grid_rows, grid_cols = struct.unpack_from('<II', data, pos)
+        pos += 8
+        layers.append((grid_rows, grid_cols, pos))
+        pos += grid_rows * grid_cols * cell_width
+
+    draw_data = []
+    for ii in range(geom_count):
+        group, shape, typecode, point_count, coord_count = struct.unpack_from('<IB1sII', data, pos)
+        pos += struct.calcsize('<IB1sII')
+        lengths = data[pos:pos + point_count]
+        pos += point_count
+        coords = array.array(typecode.decode('ascii'))
+        coords.frombytes(data[pos:pos + coord_count * coords.itemsize])
+        pos += coord_count * coords.itemsize
+        if sys.byteorder == 'big':
+            coords.byteswap()
+        coords = coords.tolist()
+
+        points = []
+        ci = 0
+        for length in lengths:
+            points.append(coords[ci:ci + length] if length > 0 else None)
+            ci += length
+        draw_data.append((lvlbin['groups'][group], SHAPE_LIST[shape], points))
+
+    level_size = (max([grid_rows for grid_rows, grid_cols, grid_pos in layers], default=0), max([grid_cols for grid_rows, grid_cols, grid_pos in layers], default=0))
+
+    region = None
+    if crop:
+        region = level_region(draw_data, level_size)
+
+    layer_grids = []
+    for grid_rows, grid_cols, grid_pos in layers:
+        row_size = grid_cols * cell_width
+        rows, cols = (0, grid_rows), (0, grid_cols)
+        if region is not None:
+            # only the region's bytes are read from the mapped file
+            rows = (min(region[0], grid_rows), min(region[2], grid_rows))
+            cols = (min(region[1], grid_cols), min(region[3], grid_cols))
+        grid = []
+        for rr in range(*rows):
+            row_pos = grid_pos + rr * row_size
+            row_data = data[row_pos + cols[0] * cell_width:row_pos + cols[1] * cell_width]
+            if lvlbin['char_table'] is not None:
+                grid.append(row_data.decode(encoding).translate(lvlbin['char_table']))
+            else:
+                cells = array.array('B' if cell_width == 1 else 'H', row_data)
+                if sys.byteorder == 'big':
+                    cells.byteswap()
+                grid.append([lvlbin['chars'][ci] for ci in cells if ci != 0])
+        layer_grids.append(grid)
+
+    return layer_grids, draw_data, region, level_size
+
+def expand_level_bin(path):
+    filename, sep, frames = path.rpartition('#')
+    if sep == '':
+        filename, frames = path, ':'
+    frame_count = open_level_bin(filename)['frame_count']
+    if ':' in frames:
+        start, stop = frames.split(':')
+        indices = range(frame_count)[slice(int(start) if start else None, int(stop) if stop else None)]
+    else:
+        indices = [int(frames)]
+    return ['%s#%d' % (filename, ii) for ii in indices]
 
 
 
@@ -311,7 +840,10 @@ def initialize_cairosvg():
         def _svg2png(svg, svg_width, svg_height, svg_scale):
             return cairosvg.svg2png(svg, background_color='#ffffff', parent_width=svg_width, parent_height=svg_height, output_width=svg_width*svg_scale, output_height=svg_height*svg_scale)
 
-        return _svg2pdf, _svg2png
+        def _png_scale(svg_scale):
+            return svg_scale
+
+        return _svg2pdf, _svg2png, _png_scale
 
     except ImportError:
         return None
@@ -349,7 +881,11 @@ def initialize_svglib():
         def _svg2png(svg, svg_width, svg_height, svg_scale):
             return reportlab.graphics.renderPM.drawToString(_svg2rlg(svg, svg_scale), fmt='PNG', dpi=72 * svg_scale, backend='_renderPM')
 
-        return _svg2pdf, _svg2png
+        def _png_scale(svg_scale):
+            # svg units are read as 96 dpi pixels, then rendered in 72 dpi points
+            return 0.75 * svg_scale
+
+        return _svg2pdf, _svg2png, _png_scale
 
     except ImportError:
         return None
@@ -363,10 +899,13 @@ def initialize_unsupported():
         print('Unsupported conversion to image. Try installing packages for cairosvg or svglib.')
         sys.exit(-1)
 
-    return _svg2pdf, _svg2png
+    def _png_scale(svg_scale):
+        return svg_scale
 
+    return _svg2pdf, _svg2png, _png_scale
 
-svg2pdf, svg2png = None, None
+
+svg2pdf, svg2png, png_scale, svg_converter = None, None, None, None
 
 initializers = [(initialize_cairosvg, 'cairosvg', not args.svglib),
                 (initialize_svglib, 'svglib', not args.cairosvg),
@@ -376,7 +915,8 @@ for initializer, name, attempt in initializers:
     if attempt:
         result = initializer()
         if result is not None:
-            svg2pdf, svg2png = result
+            svg2pdf, svg2png, png_scale = result
+            svg_converter = name
             print('using converter', name)
             break
 
@@ -386,6 +926,26 @@ if svg2pdf is None or svg2png is None:
 
 
 
+def initialize_numpy():
+    try:
+        import numpy
+        return numpy
+
+    except ImportError:
+        print('Unsupported thumbnails. Try installing packages for numpy.')
+        sys.exit(-1)
+
+numpy, thumb_lut, thumb_palette = None, None, None
+if FMT_THUMB in args.fmt or args.heatmap is not None:
+    numpy = initialize_numpy()
+if FMT_THUMB in args.fmt:
+    # maps tile code point to its row in thumb_palette; 0 means not seen yet; tiles that aren't single characters
+    # (from json levels) get codes past the last code point, and there can't be more of them than palette rows
+    thumb_lut = numpy.zeros(0x110000 + 0x10000, dtype=numpy.uint16)
+    thumb_palette = numpy.zeros((0x10000, 3), dtype=numpy.uint8)
+
+
+
 draw_order = []
 
 DRAW_STYLE_DEFAULT = {}
@@ -466,387 +1026,874 @@ def get_draw_style(group, shape):
 
 
 
+def svg_header(svg_width, svg_height):
+    return '<svg viewBox="0 0 %d %d" version="1.1" xmlns="http://www.w3.org/2000/svg" font-family="Courier, monospace" font-size="%.2fpt">\n' % (svg_width, svg_height, args.font_scale * args.cell_size)
+
+def svg_document(svg_width, svg_height, inner_svg):
+    svg = ''
+    svg += svg_header(svg_width, svg_height)
+    if args.backstage_color is not None:
+        svg += '  <rect width="100%%" height="100%%" fill="%s"/>' % args.backstage_color
+    svg += inner_svg
+    svg += '</svg>\n'
+    return svg
+
+glyph_images = {}
+
+def glyph_origin(rr, cc):
+    # converters may not map cells to whole pixels, so find the pixel a cell starts in and how far into that pixel it starts
+    scale = png_scale(args.raster_scale)
+    x, y = cc * args.cell_size * scale, rr * args.cell_size * scale
+    return (math.floor(x), math.floor(y)), (round(x - math.floor(x), 3), round(y - math.floor(y), 3))
+
+def glyph_box(rr, cc):
+    scale = png_scale(args.raster_scale)
+    return (round(cc * args.cell_size * scale), round(rr * args.cell_size * scale), round((cc + 1) * args.cell_size * scale), round((rr + 1) * args.cell_size * scale))
+
+def rasterize_glyph(char, clr, phase):
+    scale = png_scale(args.raster_scale)
+    phase_x, phase_y = phase
+
+    # draw the cell a whole number of pixels in from the corner plus its phase, so its edges land within pixels as they do in a level
+    base = math.ceil(scale)
+    svg_size = args.cell_size + 2 * math.ceil((base + 2) / scale)
+    # converters may round the image size and anchor it at the bottom, so keep it a whole number of pixels
+    for ii in range(100):
+        if abs(svg_size * scale - round(svg_size * scale)) < 0.001:
+            break
+        svg_size += 1
+    glyph_svg = '  <g transform="translate(%.4f %.4f)">\n' % ((base + phase_x) / scale, (base + phase_y) / scale) + svg_tile_text(char, clr, 0, args.cell_size - 1) + '  </g>\n'
+
+    # render over white and over black; the difference gives the coverage, and the black one is the color premultiplied by it
+    # backstage extends past the image so partly covered edge pixels don't pick up the converter's own background
+    renders = []
+    for backstage in ['#ffffff', '#000000']:
+        svg = svg_header(svg_size, svg_size) + '  <rect x="-1" y="-1" width="%d" height="%d" fill="%s"/>\n' % (svg_size + 2, svg_size + 2, backstage) + glyph_svg + '</svg>\n'
+        renders.append(PIL.Image.open(io.BytesIO(svg2png(svg, svg_size, svg_size, args.raster_scale))).convert('RGB'))
+    on_white, on_black = renders
+
+    alpha = PIL.ImageChops.invert(PIL.ImageChops.subtract(on_white, on_black)).convert('L')
+    glyph = PIL.Image.merge('RGBa', on_black.split() + (alpha,)).convert('RGBA')
+    return glyph.crop((base, base, base + math.ceil(phase_x + args.cell_size * scale), base + math.ceil(phase_y + args.cell_size * scale)))
+
+def get_glyph_tile_image(char, glyph_width, glyph_height):
+    key = (char, glyph_width, glyph_height)
+    if key not in glyph_images:
+        glyph_images[key] = tilepng[char].resize((glyph_width, glyph_height))
+    return glyph_images[key]
+
+def get_glyph_image(char, clr, phase):
+    key = (svg_converter, char, clr, phase, args.cell_size, args.raster_scale, args.font_scale, args.font_yadjust, args.tile_norect)
+    if key not in glyph_images:
+        glyph = None
+
+        glyphfilename = None
+        if args.glyph_cache_folder is not None:
+            glyphfilename = os.path.join(args.glyph_cache_folder, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.png')
+            if os.path.exists(glyphfilename):
+                glyph = load_image(glyphfilename)
+
+        if glyph is None:
+            glyph = rasterize_glyph(char, clr, phase)
+            if glyphfilename is not None:
+                os.makedirs(args.glyph_cache_folder, exist_ok=True)
+                glyph.save(glyphfilename)
+
+        glyph_images[key] = glyph
+
+    return glyph_images[key]
+
+
+
 def new_file_name(filename, newfolder, newext):
+    filename, frame = split_level_frame(filename)
     head, tail = os.path.split(filename)
     root, ext = os.path.splitext(tail)
+    if frame is not None:
+        root += '-%d' % frame
     newhead = newfolder if newfolder is not None else head
     return os.path.join(newhead, root + newext)
 
 
 
-anim_name, anim_data = None, None
-if args.fmt == FMT_GIF_ANIM:
-    anim_data = []
+def expand_level_files(paths):
+    levelfiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith('.lvl') or name.endswith('.json'):
+                    levelfiles.append(os.path.join(path, name))
+                elif name.endswith('.lvlb'):
+                    if FMT_LVLB in args.fmt and name.endswith(args.suffix + '.lvlb'):
+                        # this run's own output; packing it again would grow it every run
+                        continue
+                    try:
+                        levelfiles += expand_level_bin(os.path.join(path, name))
+                    except (OSError, RuntimeError, ValueError, struct.error):
+                        # binary level file still being written; skip it without dropping the rest of the folder
+                        continue
+        elif path.endswith('.lvlb') or '.lvlb#' in path:
+            levelfiles += expand_level_bin(path)
+        else:
+            levelfiles.append(path)
+    return levelfiles
+
+def level_file_stats(paths):
+    stats = {}
+    for path in paths:
+        try:
+            levelfiles = expand_level_files([path])
+        except (OSError, RuntimeError, ValueError, struct.error):
+            # binary level file missing or still being written
+            continue
+        for levelfile in levelfiles:
+            try:
+                stat = os.stat(split_level_frame(levelfile)[0])
+            except FileNotFoundError:
+                continue
+            stats[levelfile] = (stat.st_mtime_ns, stat.st_size)
+    return stats
 
-inner_svg = ''
-offset_x = args.padding
-offset_y = args.padding
-svg_width = args.padding
-svg_height = args.padding
-lvlxi = 0
-lvlyi = 0
 
-tilepng = {}
 
-for li, levelfile in enumerate(args.levelfiles):
-    print('processing', levelfile)
+def add_anim_frame(anim_data, frame_key, frame_png):
+    if len(anim_data) > 0 and anim_data[-1][0] == frame_key:
+        # same as previous frame; extend it instead
+        print(' - merging duplicate frame')
+        anim_data[-1][2] += args.anim_delay
+    else:
+        anim_data.append([frame_key, frame_png, args.anim_delay])
 
-    layer_grids = []
-    draw_data = []
 
-    if levelfile.endswith('.json'):
-        with open(levelfile, 'rt') as lvl:
-            level_json = json.load(lvl)
-        for layer, grid in level_json.items():
-            layer_grids.append(grid)
 
-    else:
-        with open(levelfile, 'rt') as lvl:
-            grid = []
-            for line in lvl:
-                line = line.rstrip('\n')
+# formats made from each level's svg, and which of those are animations
+svg_fmts = [fmt for fmt in args.fmt if fmt not in [FMT_LVLB, FMT_THUMB]]
+anim_fmts = [fmt for fmt in args.fmt if fmt in FMT_ANIM_LIST]
 
-                if line.startswith('META'):
-                    meta = json.loads(line[4:])
-                    if meta['type'] == 'geom':
-                        if meta['shape'] in SHAPE_LIST:
-                            draw_data.append((meta['group'], meta['shape'], meta['data']))
-                        else:
-                            print(' - WARNING: unrecognized META geom: %s' % line)
+# raster output with the glyph cache blits pre-rasterized tiles, while vector output (or raster output without the glyph cache) needs them in the svg
+raster_cells = (args.glyph_cache or args.glyph_cache_folder is not None) and any(fmt in FMT_RASTER_LIST for fmt in args.fmt)
+svg_cells = not raster_cells or FMT_SVG in args.fmt or FMT_PDF in args.fmt
 
-                else:
-                    grid.append(line)
-            layer_grids.append(grid)
+background_files = None
+if args.background_files is not None:
+    background_files = dict(zip(args.levelfiles, args.background_files))
 
-    grid_rows, grid_cols = 0, 0
-    for grid in layer_grids:
-        grid_rows = max(grid_rows, len(grid))
-        for row in grid:
-            grid_cols = max(grid_cols, len(row))
-
-    draw_data_order = []
-    for ogroup, oshape in draw_order:
-        new_draw_data = []
-        for meta in draw_data:
-            mgroup, mshape, mpoints = meta
-            if (mgroup, mshape) == (ogroup, oshape):
-                draw_data_order.append(meta)
-            else:
-                new_draw_data.append(meta)
-        draw_data = new_draw_data
-    draw_data = draw_data + draw_data_order
+tilepng = {}
 
+thumb_colors = {}
+thumb_tiles = []
+thumb_tile_codes = {}
 
+def get_thumb_code(char):
+    if len(char) == 1:
+        return ord(char)
+    if char not in thumb_tile_codes:
+        thumb_tile_codes[char] = 0x110000 + len(thumb_tiles)
+        thumb_tiles.append(char)
+    return thumb_tile_codes[char]
 
-    level_width = grid_cols * args.cell_size
-    level_height = grid_rows * args.cell_size
-    if args.montage is None:
-        inner_svg = ''
-        offset_x = args.padding
-        offset_y = args.padding
-        svg_width = args.padding + level_width
-        svg_height = args.padding + level_height
+def get_thumb_char(code):
+    return chr(code) if code < 0x110000 else thumb_tiles[code - 0x110000]
 
+def get_thumb_color(char):
+    if char not in thumb_colors:
+        color = None
 
+        if args.tile_image_folder is not None:
+            tilepngname = os.path.join(args.tile_image_folder, char + '.png')
+            if os.path.exists(tilepngname):
+                # average of sprite over white
+                tile = numpy.asarray(load_image(tilepngname), dtype=numpy.float64) / 255.0
+                alpha = tile[:, :, 3:]
+                color = tuple(int(round(255 * vv)) for vv in (tile[:, :, :3] * alpha + (1.0 - alpha)).mean(axis=(0, 1)))
+
+        if color is None:
+            if char == ' ':
+                clr = args.blank_color if args.blank_color is not None and not args.blank_none else 'white'
+            else:
+                clr = cfg['tile'][char] if char in cfg['tile'] else 'grey'
+            color = PIL.ImageColor.getrgb(clr)[:3]
 
-    pngfilename = None
-    if args.background_files is not None:
-        pngfilename = args.background_files[li]
-    elif args.background_suffix is not None:
-        pngfilename = levelfile.removesuffix(args.background_suffix) + '.png'
-    elif not args.background_none:
-        pngfilename = new_file_name(levelfile, None, '.png')
+        thumb_colors[char] = color
 
-    tile_image = None
-    text_svg = None
+    return thumb_colors[char]
 
-    added_background = False
-    if pngfilename is not None and os.path.exists(pngfilename):
-        print(' - adding background image')
-        pngdata = load_b64_image(pngfilename)
-        inner_svg += '  <image x="%d" y="%d" width="%d" height="%d" href="data:image/png;base64,%s"/>\n' % (offset_x, offset_y, level_width, level_height, pngdata)
-        added_background = True
+def level_thumbnail(layer_grids, draw_data):
+    grid_rows = max([len(grid) for grid in layer_grids], default=0)
+    grid_cols = max([max(map(len, grid), default=0) for grid in layer_grids], default=0)
 
-    if not added_background or args.tile_image_folder is not None or args.tile_text:
-        if args.tile_image_folder is not None:
-            tile_image = PIL.Image.new('RGBA', (level_width, level_height), (0, 0, 0, 0))
-
-        for grid in reversed(layer_grids):
-            for linei, line in enumerate(grid):
-                for chari, char in enumerate(line):
-                    inner_x = chari * args.cell_size
-                    inner_y = (linei + 1) * args.cell_size - 1
-                    x = inner_x + offset_x
-                    y = inner_y + offset_y
-
-                    if char == ' ':
-                        if args.blank_none:
-                            continue
-                        if args.blank_color is not None and not args.tile_norect:
-                            text_svg += '  <rect x="%d" y="%d" width="%d" height="%d" style="stroke:none;fill:%s;fill-opacity:%.2f"/>\n' % (x, y - args.cell_size + 1, args.cell_size, args.cell_size, args.blank_color, 1.0)
-                            continue
-
-                    if args.tile_image_folder is not None and char not in tilepng:
-                        tilepngname = os.path.join(args.tile_image_folder, char + '.png')
-                        if os.path.exists(tilepngname):
-                            image = load_image(tilepngname)
-                            if image.size != (args.cell_size, args.cell_size):
-                                image = image.resize((args.cell_size, args.cell_size))
-                            tilepng[char] = image
-                        else:
-                            tilepng[char] = None
-
-                    added_tile_image = False
-                    if char in tilepng and tilepng[char] is not None:
-                        tile_image.paste(tilepng[char], (inner_x, inner_y - args.cell_size + 1))
-                        added_tile_image = True
-
-                    if not added_tile_image or args.tile_text:
-                        clr = cfg['tile'][char] if char in cfg['tile'] else 'grey'
-
-                        custom = None
-                        if char == '<':
-                            char = '&lt;'
-                        elif char == '>':
-                            char = '&gt;'
-                        elif char == '&':
-                            char = '&#38;'
-                        elif char in '─│┐┘└┌':
-                            pth = {'─': (0.0, 0.5, 1.0, 0.5), '│': (0.5, 0.0, 0.5, 1.0), '┐': (0.5, 1.0, 0.0, 0.5), '┘': (0.0, 0.5, 0.5, 0.0), '└': (0.5, 0.0, 1.0, 0.5), '┌': (1.0, 0.5, 0.5, 1.0)}[char]
-                            gz = args.cell_size
-                            yo = y - gz + 1
-                            char = None
-                            custom = '<path d="M %.2f %.2f L %.2f %.2f L %.2f %.2f" stroke="%s" stroke-width="1" stroke-linecap="round" fill="none"/>' % (x + gz * pth[0], yo + gz * pth[1], x + gz * 0.5, yo + gz * 0.5, x + gz * pth[2], yo + gz * pth[3], clr)
-
-                        if text_svg is None:
-                            text_svg = ''
-
-                        if custom is not None:
-                            text_svg += '  ' + custom + '\n'
-                        if char is not None:
-                            xscale = 1.0 / len(char)
-                            text_svg += '  <text x="%.2f" y="%.2f" transform="scale(%.2f, 1.0)" dominant-baseline="middle" text-anchor="middle" fill="%s" style="fill-opacity:%.2f">%s</text>\n' % ((x + 0.5 * args.cell_size) / xscale, y - (0.5 - args.font_yadjust) * args.cell_size, xscale, clr, 1.0, char)
-                        if not args.tile_norect:
-                            text_svg += '  <rect x="%d" y="%d" width="%d" height="%d" style="stroke:none;fill:%s;fill-opacity:%.2f"/>\n' % (x, y - args.cell_size + 1, args.cell_size, args.cell_size, clr, 0.3)
-
-    if tile_image is not None:
-        print(' - adding tile images')
-        pngdata = b64_image(tile_image)
-        inner_svg += '  <image x="%d" y="%d" width="%d" height="%d" href="data:image/png;base64,%s"/>\n' % (offset_x, offset_y, level_width, level_height, pngdata)
-
-    if text_svg is not None:
-        print(' - adding tile text')
-        inner_svg += text_svg
-
-    for group, shape, points in draw_data:
-        if shape == SHAPE_TILE:
-            tile_color = get_draw_color(group)
-            tile_style = get_draw_style(group, SHAPE_TILE)
-
-            if tile_style == RECT_NONE:
+    # later layers are drawn first, so earlier layers cover them except where blank
+    cells = None
+    for grid in reversed(layer_grids):
+        if all(isinstance(row, str) for row in grid):
+            text = ''.join([row.ljust(grid_cols) for row in grid]).ljust(grid_rows * grid_cols)
+            layer = numpy.frombuffer(text.encode('utf-32-le'), dtype='<u4').reshape(grid_rows, grid_cols)
+        else:
+            # json rows are lists of tiles, which may not be single characters
+            layer = numpy.full((grid_rows, grid_cols), ord(' '), dtype=numpy.uint32)
+            for rr, row in enumerate(grid):
+                layer[rr, :len(row)] = [get_thumb_code(char) for char in row]
+        if cells is None:
+            cells = layer
+        else:
+            cells = numpy.where(layer != ord(' '), layer, cells)
+    if cells is None:
+        cells = numpy.full((grid_rows, grid_cols), ord(' '), dtype=numpy.uint32)
+
+    indices = thumb_lut[cells]
+    if not indices.all():
+        for code in numpy.unique(cells[indices == 0]).tolist():
+            index = len(thumb_colors) + 1
+            thumb_palette[index] = get_thumb_color(get_thumb_char(code))
+            thumb_lut[code] = index
+        indices = thumb_lut[cells]
+
+    image = thumb_palette[indices]
+    image = image.repeat(args.thumb_scale, axis=0).repeat(args.thumb_scale, axis=1)
+
+    if args.thumb_overlay:
+        for group, shape, points in draw_data:
+            if shape == SHAPE_TILE:
+                if get_draw_style(group, SHAPE_TILE) == RECT_NONE:
+                    continue
+                coords = [point for point in points]
+            elif shape == SHAPE_PATH:
+                if get_draw_style(group, SHAPE_PATH) == PATH_NONE:
+                    continue
+                coords = []
+                for point in points:
+                    if point is None or len(point) == 0:
+                        continue
+                    elif len(point) == 6:
+                        coords += [point[0:2], point[2:4]]
+                    else:
+                        coords += [point[ii:ii + 2] for ii in range(0, len(point), 2)]
+            else:
                 continue
 
-            print(' - adding tiles %s' % group)
+            if len(coords) == 0:
+                continue
 
-            drawn = set()
-            for rr, cc in points:
-                if tile_style in [RECT_BORDER, RECT_BORDER_THICK]:
-                    sides = ([rr - 1, cc] not in points, [rr + 1, cc] not in points, [rr, cc - 1] not in points, [rr, cc + 1] not in points)
-                else:
-                    sides = None
-                inner_svg += svg_rect(rr, cc, 1, 1, offset_x, offset_y, sides, tile_style, tile_color, drawn)
+            coords = numpy.array(coords, dtype=numpy.float64).reshape(-1, 2).astype(numpy.int64)
+            coords = coords[(coords[:, 0] >= 0) & (coords[:, 0] < grid_rows) & (coords[:, 1] >= 0) & (coords[:, 1] < grid_cols)]
+            coords = coords * args.thumb_scale + args.thumb_scale // 2
+            image[coords[:, 0], coords[:, 1]] = PIL.ImageColor.getrgb(get_draw_color(group))[:3]
 
-        elif shape == SHAPE_RECT:
-            rect_color = get_draw_color(group)
-            rect_style = get_draw_style(group, SHAPE_RECT)
+    return image
 
-            if rect_style == RECT_NONE:
-                continue
+def render_thumbnails(levelfiles):
+    if args.montage is None:
+        pages = [[levelfile] for levelfile in levelfiles]
+        MAX_X, PAD_X, PAD_Y = 1, 0, 0
+    else:
+        pages = montage_pages(levelfiles)
+        MAX_X, MAX_Y, PAD_X, PAD_Y = args.montage
 
-            print(' - adding rects %s' % group)
+    backstage = PIL.ImageColor.getrgb(args.backstage_color)[:3] if args.backstage_color is not None else (255, 255, 255)
 
-            drawn = set()
-            for r1, c1, r2, c2 in points:
-                inner_svg += svg_rect(r1, c1, r2 - r1, c2 - c1, offset_x, offset_y, None, rect_style, rect_color, drawn)
+    print('processing %d levels' % len(levelfiles))
 
-        elif shape == SHAPE_LINE:
-            line_color = get_draw_color(group)
-            line_style = get_draw_style(group, SHAPE_LINE)
+    for page in pages:
+        thumbs = [level_thumbnail(*load_level(levelfile)) for levelfile in page]
 
-            if line_style == PATH_NONE:
+        if MAX_X > 0:
+            rows = [thumbs[ii:ii + MAX_X] for ii in range(0, len(thumbs), MAX_X)]
+        else:
+            rows = [thumbs]
+
+        row_heights = [max([thumb.shape[0] for thumb in row]) for row in rows]
+        row_widths = [sum([thumb.shape[1] for thumb in row]) + PAD_X * (len(row) - 1) for row in rows]
+
+        sheet_height = 2 * args.padding + sum(row_heights) + PAD_Y * (len(rows) - 1)
+        sheet_width = 2 * args.padding + max(row_widths)
+        sheet = numpy.empty((sheet_height, sheet_width, 3), dtype=numpy.uint8)
+        sheet[:, :] = backstage
+
+        yy = args.padding
+        for row, row_height in zip(rows, row_heights):
+            xx = args.padding
+            for thumb in row:
+                sheet[yy:yy + thumb.shape[0], xx:xx + thumb.shape[1]] = thumb
+                xx += thumb.shape[1] + PAD_X
+            yy += row_height + PAD_Y
+
+        outfilename = new_file_name(page[-1], args.outfolder, args.suffix + '.thumb.png')
+        print(' - writing', outfilename)
+        PIL.Image.fromarray(sheet).save(outfilename, compress_level=1)
+
+def render_heatmap(levelfiles):
+    # only the counts are kept, so memory does not grow with the number of levels
+    cell_counts = numpy.zeros((0, 0), dtype=numpy.int64)
+    edge_counts = {}
+
+    print('processing %d levels' % len(levelfiles))
+
+    for levelfile in levelfiles:
+        layer_grids, draw_data = load_level(levelfile)
+
+        edges = []
+        group_tiles, group_points = {}, {}
+        for group, shape, points in draw_data:
+            if group not in args.heatmap:
+                continue
+            if shape == SHAPE_TILE:
+                group_tiles[group] = group_tiles.get(group, []) + points
+            elif shape == SHAPE_PATH:
+                path_edge_list, solitary_points = path_edges(points)
+                edges += path_edge_list
+                group_points[group] = group_points.get(group, []) + path_points(path_edge_list) + solitary_points
+            elif shape == SHAPE_LINE:
+                edges += points
+                group_points[group] = group_points.get(group, []) + path_points(points)
+
+        # groups often have both a path and tiles for the cells along it, so only use points where there are no tiles
+        tiles = []
+        for group in args.heatmap:
+            tiles += group_tiles.get(group, group_points.get(group, []))
+
+        if len(tiles) > 0:
+            tiles = numpy.array(tiles, dtype=numpy.float64).reshape(-1, 2).astype(numpy.int64)
+            tiles = tiles[(tiles >= 0).all(axis=1)]
+        if len(tiles) > 0:
+            grid_rows, grid_cols = (tiles.max(axis=0) + 1).tolist()
+            if grid_rows > cell_counts.shape[0] or grid_cols > cell_counts.shape[1]:
+                cell_counts = numpy.pad(cell_counts, ((0, max(0, grid_rows - cell_counts.shape[0])), (0, max(0, grid_cols - cell_counts.shape[1]))))
+            numpy.add.at(cell_counts, (tiles[:, 0], tiles[:, 1]), 1)
+
+        if len(edges) > 0:
+            # count edges regardless of direction
+            edges = numpy.array(edges, dtype=numpy.float64).reshape(-1, 4)
+            flip = (edges[:, 0] > edges[:, 2]) | ((edges[:, 0] == edges[:, 2]) & (edges[:, 1] > edges[:, 3]))
+            edges[flip] = edges[flip][:, [2, 3, 0, 1]]
+            edges, counts = numpy.unique(edges, axis=0, return_counts=True)
+            for edge, count in zip(map(tuple, edges.tolist()), counts.tolist()):
+                edge_counts[edge] = edge_counts.get(edge, 0) + count
+
+    reference = args.heatmap_reference if args.heatmap_reference is not None else levelfiles[0]
+    render_levels([reference], None, (cell_counts, edge_counts, get_draw_color(args.heatmap[0])))
+
+def render_levels(levelfiles, frame_cache, heatmap):
+    anim_name, anim_data = None, None
+    if len(anim_fmts) > 0:
+        anim_data = []
+    anim_rasters = {}
+
+    pack_name, pack_data = None, []
+
+    inner_svg = ''
+    inner_raster_svg = ''
+    offset_x = args.padding
+    offset_y = args.padding
+    svg_width = args.padding
+    svg_height = args.padding
+    lvlxi = 0
+    lvlyi = 0
+
+
+    for li, levelfile in enumerate(levelfiles):
+        if frame_cache is not None and levelfile in frame_cache:
+            print('reusing', levelfile)
+            if anim_name is None:
+                anim_name = levelfile
+            add_anim_frame(anim_data, *frame_cache[levelfile])
+            continue
+
+        print('processing', levelfile)
+
+        layer_grids, draw_data, region, level_size = load_level_region(levelfile, True)
+
+        if FMT_LVLB in args.fmt:
+            if pack_name is None:
+                pack_name = levelfile
+            pack_data.append((layer_grids, draw_data))
+            if len(svg_fmts) == 0:
                 continue
 
-            print(' - adding lines %s' % group)
+        grid_rows, grid_cols = 0, 0
+        for grid in layer_grids:
+            grid_rows = max(grid_rows, len(grid))
+            for row in grid:
+                grid_cols = max(grid_cols, len(row))
+        if region is not None:
+            # output is sized to the region, even where its rows are short
+            grid_rows, grid_cols = region[2] - region[0], region[3] - region[1]
+
+        draw_data_order = []
+        for ogroup, oshape in draw_order:
+            new_draw_data = []
+            for meta in draw_data:
+                mgroup, mshape, mpoints = meta
+                if (mgroup, mshape) == (ogroup, oshape):
+                    draw_data_order.append(meta)
+                else:
+                    new_draw_data.append(meta)
+            draw_data = new_draw_data
+        draw_data = draw_data + draw_data_order
+
 
-            if args.no_avoid:
-                avoid_edges = None
-            else:
-                avoid_edges = [(r1, c1, r2, c2) for (r1, c1, r2, c2) in points]
 
-            dots = {}
-            if '-srcdst' in line_style:
-                srcs, dsts = {}, {}
-                for r1, c1, r2, c2 in points:
-                    srcs[(r1, c1)] = None
-                    dsts[(r2, c2)] = None
+        level_width = grid_cols * args.cell_size
+        level_height = grid_rows * args.cell_size
+        if args.montage is None:
+            inner_svg = ''
+            inner_raster_svg = ''
+            offset_x = args.padding
+            offset_y = args.padding
+            svg_width = args.padding + level_width
+            svg_height = args.padding + level_height
+
+
+
+        pngfilename = None
+        if background_files is not None:
+            pngfilename = background_files.get(levelfile)
+        elif args.background_suffix is not None:
+            pngfilename = levelfile.removesuffix(args.background_suffix) + '.png'
+        elif not args.background_none:
+            pngfilename = new_file_name(levelfile, None, '.png')
+
+        tile_image = None
+        cell_image = None
+        text_svg = None
+        background_svg = ''
+
+        added_background = pngfilename is not None and os.path.exists(pngfilename)
+        draw_tiles = not added_background or args.tile_image_folder is not None or args.tile_text
+
+        if draw_tiles and raster_cells:
+            # background, tile images, and tile text are blitted into one opaque image, since not all converters
+            # handle image transparency; it has the converter's output size so it isn't resampled
+            scale = png_scale(args.raster_scale)
+            cell_image = PIL.Image.new('RGBA', (round(level_width * scale), round(level_height * scale)), args.backstage_color if args.backstage_color is not None else 'white')
+
+        if added_background:
+            print(' - adding background image')
+            if svg_cells or cell_image is None:
+                pngdata = b64_image(load_region_image(pngfilename, region, level_size))
+                background_svg = '  <image x="%d" y="%d" width="%d" height="%d" href="data:image/png;base64,%s"/>\n' % (offset_x, offset_y, level_width, level_height, pngdata)
+            if cell_image is not None:
+                cell_image.alpha_composite(load_region_image(pngfilename, region, level_size).resize(cell_image.size))
+
+        if draw_tiles:
+            if args.tile_image_folder is not None and svg_cells:
+                tile_image = PIL.Image.new('RGBA', (level_width, level_height), (0, 0, 0, 0))
+
+            for grid in reversed(layer_grids):
+                for linei, line in enumerate(grid):
+                    for chari, char in enumerate(line):
+                        inner_x = chari * args.cell_size
+                        inner_y = (linei + 1) * args.cell_size - 1
+                        x = inner_x + offset_x
+                        y = inner_y + offset_y
+
+                        if char == ' ':
+                            if args.blank_none:
+                                continue
+                            if args.blank_color is not None and not args.tile_norect:
+                                if cell_image is not None:
+                                    cell_image.paste(args.blank_color, glyph_box(linei, chari))
+                                if svg_cells:
+                                    if text_svg is None:
+                                        text_svg = ''
+                                    text_svg += '  <rect x="%d" y="%d" width="%d" height="%d" style="stroke:none;fill:%s;fill-opacity:%.2f"/>\n' % (x, y - args.cell_size + 1, args.cell_size, args.cell_size, args.blank_color, 1.0)
+                                continue
+
+                        if args.tile_image_folder is not None and char not in tilepng:
+                            tilepngname = os.path.join(args.tile_image_folder, char + '.png')
+                            if os.path.exists(tilepngname):
+                                image = load_image(tilepngname)
+                                if image.size != (args.cell_size, args.cell_size):
+                                    image = image.resize((args.cell_size, args.cell_size))
+                                tilepng[char] = image
+                            else:
+                                tilepng[char] = None
+
+                        added_tile_image = False
+                        if char in tilepng and tilepng[char] is not None:
+                            if cell_image is not None:
+                                x0, y0, x1, y1 = glyph_box(linei, chari)
+                                cell_image.alpha_composite(get_glyph_tile_image(char, x1 - x0, y1 - y0), (x0, y0))
+                            if svg_cells:
+                                tile_image.paste(tilepng[char], (inner_x, inner_y - args.cell_size + 1))
+                            added_tile_image = True
+
+                        if not added_tile_image or args.tile_text:
+                            clr = cfg['tile'][char] if char in cfg['tile'] else 'grey'
+
+                            if cell_image is not None:
+                                origin, phase = glyph_origin(linei, chari)
+                                glyph = get_glyph_image(char, clr, phase)
+                                # glyphs on the last row or column may reach past the image
+                                cell_image.alpha_composite(glyph.crop((0, 0, min(glyph.width, cell_image.width - origin[0]), min(glyph.height, cell_image.height - origin[1]))), origin)
+                            if svg_cells:
+                                if text_svg is None:
+                                    text_svg = ''
+                                text_svg += svg_tile_text(char, clr, x, y)
+
+        tiles_svg = background_svg
+
+        if tile_image is not None:
+            print(' - adding tile images')
+            pngdata = b64_image(tile_image)
+            tiles_svg += '  <image x="%d" y="%d" width="%d" height="%d" href="data:image/png;base64,%s"/>\n' % (offset_x, offset_y, level_width, level_height, pngdata)
+
+        if text_svg is not None:
+            print(' - adding tile text')
+            tiles_svg += text_svg
+
+        raster_tiles_svg = background_svg
+
+        if cell_image is not None:
+            print(' - adding tile raster')
+            pngdata = b64_image(cell_image)
+            raster_tiles_svg = '  <image x="%d" y="%d" width="%d" height="%d" href="data:image/png;base64,%s"/>\n' % (offset_x, offset_y, level_width, level_height, pngdata)
+
+        geom_svg = ''
+
+        # geoms keep level coordinates, so shift them so the region's corner is at the offset
+        geom_x, geom_y = offset_x, offset_y
+        geom_clip = None
+        if region is not None:
+            geom_x -= region[1] * args.cell_size
+            geom_y -= region[0] * args.cell_size
+            # lines and paths are cut at the level's edge, inset so their round caps stay inside it too
+            geom_clip = (offset_x + 1, offset_y + 1, offset_x + level_width - 1, offset_y + level_height - 1)
+
+        for group, shape, points in draw_data:
+            if shape == SHAPE_TILE:
+                tile_color = get_draw_color(group)
+                tile_style = get_draw_style(group, SHAPE_TILE)
+
+                if tile_style == RECT_NONE:
+                    continue
+
+                print(' - adding tiles %s' % group)
+
+                drawn = set()
+                for rr, cc in points:
+                    if not region_has_cell(region, rr, cc):
+                        continue
+                    if tile_style in [RECT_BORDER, RECT_BORDER_THICK]:
+                        sides = ([rr - 1, cc] not in points, [rr + 1, cc] not in points, [rr, cc - 1] not in points, [rr, cc + 1] not in points)
+                    else:
+                        sides = None
+                    geom_svg += svg_rect(rr, cc, 1, 1, geom_x, geom_y, sides, tile_style, tile_color, drawn)
+
+            elif shape == SHAPE_RECT:
+                rect_color = get_draw_color(group)
+                rect_style = get_draw_style(group, SHAPE_RECT)
+
+                if rect_style == RECT_NONE:
+                    continue
+
+                print(' - adding rects %s' % group)
+
+                drawn = set()
                 for r1, c1, r2, c2 in points:
-                    if (r1, c1) not in dsts:
-                        dots[(r1, c1)] = None
-                    if (r2, c2) not in srcs:
-                        dots[(r2, c2)] = None
+                    clipped = region_clip_rect(region, r1, c1, r2, c2)
+                    if clipped is None:
+                        continue
+                    r1, c1, r2, c2 = clipped
+                    geom_svg += svg_rect(r1, c1, r2 - r1, c2 - c1, geom_x, geom_y, None, rect_style, rect_color, drawn)
+
+            elif shape == SHAPE_LINE:
+                line_color = get_draw_color(group)
+                line_style = get_draw_style(group, SHAPE_LINE)
 
-            for ii, (r1, c1, r2, c2) in enumerate(points):
-                inner_svg += svg_line(r1, c1, r2, c2, offset_x, offset_y, line_color, 'arc-' in line_style, avoid_edges, (r1, c1) in dots, (r2, c2) in dots, '-arrow' in line_style, '-point' in line_style, '-dash' in line_style, '-thick' in line_style)
+                if line_style == PATH_NONE:
+                    continue
 
-        elif shape == SHAPE_PATH:
-            path_color = get_draw_color(group)
-            path_style = get_draw_style(group, SHAPE_PATH)
+                print(' - adding lines %s' % group)
 
-            if path_style == PATH_NONE:
+                if args.no_avoid:
+                    avoid_edges = None
+                else:
+                    avoid_edges = [(r1, c1, r2, c2) for (r1, c1, r2, c2) in points]
+
+                dots = {}
+                if '-srcdst' in line_style:
+                    srcs, dsts = {}, {}
+                    for r1, c1, r2, c2 in points:
+                        srcs[(r1, c1)] = None
+                        dsts[(r2, c2)] = None
+                    for r1, c1, r2, c2 in points:
+                        if (r1, c1) not in dsts:
+                            dots[(r1, c1)] = None
+                        if (r2, c2) not in srcs:
+                            dots[(r2, c2)] = None
+
+                for ii, (r1, c1, r2, c2) in enumerate(points):
+                    if not region_has_edge(region, r1, c1, r2, c2):
+                        continue
+                    geom_svg += svg_line(r1, c1, r2, c2, geom_x, geom_y, line_color, 'arc-' in line_style, avoid_edges, (r1, c1) in dots, (r2, c2) in dots, '-arrow' in line_style, '-point' in line_style, '-dash' in line_style, '-thick' in line_style, geom_clip)
+
+            elif shape == SHAPE_PATH:
+                path_color = get_draw_color(group)
+                path_style = get_draw_style(group, SHAPE_PATH)
+
+                if path_style == PATH_NONE:
+                    continue
+
+                edges, solitary_points = path_edges(points)
+
+                print(' - adding path %s' % group)
+                for r1, c1 in solitary_points:
+                    print(' - WARNING: skipping solitary path point: %f %f' % (r1, c1))
+
+                if args.no_avoid:
+                    avoid_edges = None
+                else:
+                    avoid_edges = [(r1, c1, r2, c2) for (r1, c1, r2, c2) in edges]
+
+                for ii, (r1, c1, r2, c2) in enumerate(edges):
+                    if not region_has_edge(region, r1, c1, r2, c2):
+                        continue
+                    geom_svg += svg_line(r1, c1, r2, c2, geom_x, geom_y, path_color, 'arc-' in path_style, avoid_edges, ii == 0, ii + 1 == len(edges), '-arrow' in path_style, '-point' in path_style, '-dash' in path_style, '-thick' in path_style, geom_clip)
+
+        if heatmap is not None:
+            print(' - adding heatmap')
+            geom_svg += svg_heatmap(heatmap, offset_x, offset_y)
+
+        if svg_cells:
+            inner_svg += tiles_svg + geom_svg
+        if raster_cells:
+            inner_raster_svg += raster_tiles_svg + geom_svg
+
+        finish_svg = True
+        if args.montage is not None:
+            MAX_X, MAX_Y, PAD_X, PAD_Y = args.montage
+            finish_svg = False
+            if lvlxi == 0:
+                # Adding a new row adds to height.
+                svg_height += level_height
+            # Add to row
+            lvlxi += 1
+            offset_x += level_width + PAD_X
+            if lvlyi == 0:
+                # Adding to first row adds to width.
+                svg_width += level_width
+            if li == len(levelfiles) - 1:
+                # Print at the last level regardless.
+                finish_svg = True
+            elif lvlxi == MAX_X:
+                # Add a new row; reset x offset and increase y offset.
+                lvlxi = 0
+                offset_x = args.padding
+                lvlyi += 1
+                offset_y += level_height + PAD_Y
+                if lvlyi == MAX_Y:
+                    # Start a new svg entirely.
+                    lvlyi = 0
+                    offset_y = args.padding
+                    finish_svg = True
+                else:
+                    # Prep for new row.
+                    svg_height += PAD_Y
+            elif lvlyi == 0:
+                # Prep for adding to row.
+                svg_width += PAD_X
+
+        if not finish_svg:
+            continue
+
+        svg_width += args.padding
+        svg_height += args.padding
+
+        svg = None
+        if svg_cells:
+            svg = svg_document(svg_width, svg_height, inner_svg)
+        raster_svg = svg_document(svg_width, svg_height, inner_raster_svg) if raster_cells else svg
+
+        raster_png = None
+        if any(fmt in FMT_RASTER_LIST for fmt in svg_fmts):
+            # png and animation frames share one conversion; identical svgs rasterize identically, so only convert each one once
+            frame_key = hashlib.sha1(raster_svg.encode('utf-8')).hexdigest()
+            if frame_key in anim_rasters:
+                raster_png = anim_rasters[frame_key]
+            else:
+                raster_png = svg2png(raster_svg, svg_width, svg_height, args.raster_scale)
+                if len(anim_fmts) > 0:
+                    anim_rasters[frame_key] = raster_png
+
+        if len(anim_fmts) > 0:
+            if anim_name is None:
+                anim_name = levelfile
+            add_anim_frame(anim_data, frame_key, raster_png)
+            if frame_cache is not None:
+                frame_cache[levelfile] = (frame_key, raster_png)
+
+        if args.montage is not None:
+            # Reset for next svg.
+            inner_svg = ''
+            inner_raster_svg = ''
+            svg_width = args.padding
+            svg_height = args.padding
+            offset_x = args.padding
+            offset_y = args.padding
+
+        for fmt in svg_fmts:
+            if fmt == FMT_SVG:
+                data = svg
+                mode = 't'
+                ext = '.svg'
+            elif fmt == FMT_PDF:
+                data = svg2pdf(svg)
+                mode = 'b'
+                ext = '.pdf'
+            elif fmt == FMT_PNG:
+                data = raster_png
+                mode = 'b'
+                ext = '.png'
+            elif fmt in FMT_ANIM_LIST:
                 continue
+            else:
+                raise RuntimeError('unknown format for output: %s' % fmt)
 
-            solitary_points = []
-            edges = []
+            if args.stdout:
+                sys.stdout.write(data)
 
-            prev_point_connected = False
-            prev_point = None
-            for point in points:
-                if point is None or len(point) == 0:
-                    if prev_point is not None and not prev_point_connected:
-                        solitary_points.append(prev_point)
-                    prev_point_connected = False
-                    prev_point = None
-                elif len(point) == 2:
-                    if prev_point is not None:
-                        edges.append([prev_point[0], prev_point[1], point[0], point[1]])
-                    prev_point_connected = prev_point is not None
-                    prev_point = point
-                elif len(point) == 4:
-                    edges.append(point)
-                    prev_point_connected = True
-                    prev_point = [point[-2], point[-1]]
-                elif len(point) == 6:
-                    fr, fc, tr, tc, pwtr, pwtc = point
-                    edges.append([fr, fc, pwtr, pwtc])
-                    edges.append([tr - (pwtr - fr), tc - (pwtc - fc), tr, tc])
-                    prev_point_connected = True
-                    prev_point = [tr, tc]
-                else:
-                    raise RuntimeError('unknown point type: %s' % str(point))
+            else:
+                if heatmap is not None:
+                    ext = '.heat' + ext
+                outfilename = new_file_name(levelfile, args.outfolder, args.suffix + ext)
+                print(' - writing', outfilename)
+                outfile = open(outfilename, 'w' + mode)
+                outfile.write(data)
+
+    if len(anim_fmts) > 0 and anim_name is not None:
+        frames = [PIL.Image.open(io.BytesIO(frame_png)) for frame_key, frame_png, frame_duration in anim_data]
+        durations = [frame_duration for frame_key, frame_png, frame_duration in anim_data]
+
+    for fmt in anim_fmts:
+        if anim_name is None:
+            break
 
-            if prev_point is not None and not prev_point_connected:
-                solitary_points.append(prev_point)
+        if fmt == FMT_GIF_ANIM:
+            ext = '.anim.gif'
+        elif fmt == FMT_APNG:
+            ext = '.anim.png'
+        elif fmt == FMT_WEBP_ANIM:
+            ext = '.anim.webp'
+
+        outfilename = new_file_name(anim_name, args.outfolder, args.suffix + ext)
+        print(' - writing', outfilename)
 
-            print(' - adding path %s' % group)
-            for r1, c1 in solitary_points:
-                print(' - WARNING: skipping solitary path point: %f %f' % (r1, c1))
+        if fmt == FMT_GIF_ANIM:
+            # put all the images into one image to find a good palette
+            img_meta = PIL.Image.new('RGB', (frames[0].width, frames[0].height * len(frames)))
+            for ii, img in enumerate(frames):
+                img_meta.paste(img, (0, frames[0].height * ii))
+            img_meta = img_meta.quantize(colors=256, dither=0)
+            imgs = [img.quantize(palette=img_meta, dither=0) for img in frames]
 
-            if args.no_avoid:
-                avoid_edges = None
+            # duplicate frames were already merged into longer durations
+            imgs[0].save(fp=outfilename, append_images=imgs[1:], save_all=True, duration=durations, loop=0, optimize=False, disposal=2)
+
+        else:
+            # full color frames; no palette needed
+            imgs = [img.convert('RGB') for img in frames]
+
+            if fmt == FMT_APNG:
+                # leaving previous frame in place and replacing pixels lets each frame store only its changed region
+                imgs[0].save(fp=outfilename, format='PNG', append_images=imgs[1:], save_all=True, duration=durations, loop=0, disposal=PIL.PngImagePlugin.Disposal.OP_NONE, blend=PIL.PngImagePlugin.Blend.OP_SOURCE, compress_level=args.anim_compress)
+            elif fmt == FMT_WEBP_ANIM:
+                # encoder stores changed sub-rectangles between keyframes
+                imgs[0].save(fp=outfilename, format='WEBP', append_images=imgs[1:], save_all=True, duration=durations, loop=0, lossless=True, method=min(args.anim_compress, 6), quality=100.0 * args.anim_compress / 9)
+
+
+
+    if FMT_LVLB in args.fmt and pack_name is not None:
+        outfilename = new_file_name(pack_name, args.outfolder, args.suffix + '.lvlb')
+        print(' - writing', outfilename)
+        write_level_bin(outfilename, pack_data)
+
+
+
+def render(levelfiles, frame_cache):
+    if FMT_THUMB in args.fmt:
+        render_thumbnails(levelfiles)
+    if args.heatmap is not None:
+        render_heatmap(levelfiles)
+    elif len(svg_fmts) > 0 or FMT_LVLB in args.fmt:
+        render_levels(levelfiles, frame_cache, None)
+
+def montage_pages(levelfiles):
+    MAX_X, MAX_Y, PAD_X, PAD_Y = args.montage
+    if MAX_X <= 0 or MAX_Y <= 0:
+        return [levelfiles]
+    page_size = MAX_X * MAX_Y
+    return [levelfiles[ii:ii + page_size] for ii in range(0, len(levelfiles), page_size)]
+
+def watch_levels(stats, frame_cache):
+    print('watching for changes')
+
+    prev_levelfiles = list(stats.keys())
+    pending = {}
+    while True:
+        time.sleep(args.watch_interval)
+
+        current = level_file_stats(args.levelfiles)
+
+        ready = []
+        for levelfile, stat in current.items():
+            if stats.get(levelfile) == stat:
+                pending.pop(levelfile, None)
+            elif pending.get(levelfile) == stat:
+                # unchanged since last check, so assume writing is finished
+                ready.append(levelfile)
+                del pending[levelfile]
             else:
-                avoid_edges = [(r1, c1, r2, c2) for (r1, c1, r2, c2) in edges]
+                pending[levelfile] = stat
 
-            for ii, (r1, c1, r2, c2) in enumerate(edges):
-                inner_svg += svg_line(r1, c1, r2, c2, offset_x, offset_y, path_color, 'arc-' in path_style, avoid_edges, ii == 0, ii + 1 == len(edges), '-arrow' in path_style, '-point' in path_style, '-dash' in path_style, '-thick' in path_style)
+        removed = [levelfile for levelfile in stats if levelfile not in current]
 
-    finish_svg = True
-    if args.montage is not None:
-        MAX_X, MAX_Y, PAD_X, PAD_Y = args.montage
-        finish_svg = False
-        if lvlxi == 0:
-            # Adding a new row adds to height.
-            svg_height += level_height
-        # Add to row
-        lvlxi += 1
-        offset_x += level_width + PAD_X
-        if lvlyi == 0:
-            # Adding to first row adds to width.
-            svg_width += level_width
-        if li == len(args.levelfiles) - 1:
-            # Print at the last level regardless.
-            finish_svg = True
-        elif lvlxi == MAX_X:
-            # Add a new row; reset x offset and increase y offset.
-            lvlxi = 0
-            offset_x = args.padding
-            lvlyi += 1
-            offset_y += level_height + PAD_Y
-            if lvlyi == MAX_Y:
-                # Start a new svg entirely.
-                lvlyi = 0
-                offset_y = args.padding
-                finish_svg = True
+        if len(ready) == 0 and len(removed) == 0:
+            continue
+
+        for levelfile in ready:
+            stats[levelfile] = current[levelfile]
+            if frame_cache is not None:
+                frame_cache.pop(levelfile, None)
+        for levelfile in removed:
+            del stats[levelfile]
+            if frame_cache is not None:
+                frame_cache.pop(levelfile, None)
+
+        levelfiles = [levelfile for levelfile in current if levelfile in stats]
+        if len(levelfiles) == 0:
+            continue
+
+        if args.montage is not None:
+            if len(anim_fmts) > 0:
+                render_sets = [levelfiles]
             else:
-                # Prep for new row.
-                svg_height += PAD_Y
-        elif lvlyi == 0:
-            # Prep for adding to row.
-            svg_width += PAD_X
+                # only pages whose levels changed or shifted
+                prev_pages = montage_pages(prev_levelfiles)
+                render_sets = []
+                for pi, page in enumerate(montage_pages(levelfiles)):
+                    if pi >= len(prev_pages) or page != prev_pages[pi] or any(levelfile in ready for levelfile in page):
+                        render_sets.append(page)
+        elif len(anim_fmts) > 0 or FMT_LVLB in args.fmt or args.heatmap is not None:
+            render_sets = [levelfiles]
+        else:
+            render_sets = [[levelfile] for levelfile in ready]
 
-    if not finish_svg:
-        continue
+        for render_set in render_sets:
+            try:
+                render(render_set, frame_cache)
+            except Exception as e:
+                print(' - WARNING: render failed: %s' % e)
 
-    svg = ''
-    svg_width += args.padding
-    svg_height += args.padding
-    svg += '<svg viewBox="0 0 %d %d" version="1.1" xmlns="http://www.w3.org/2000/svg" font-family="Courier, monospace" font-size="%.2fpt">\n' % (svg_width, svg_height, args.font_scale * args.cell_size)
-    if args.backstage_color is not None:
-        svg += '  <rect width="100%%" height="100%%" fill="%s"/>' % args.backstage_color
-    svg += inner_svg
-    svg += '</svg>\n'
+        prev_levelfiles = levelfiles
 
-    if args.fmt == FMT_SVG:
-        data = svg
-        mode = 't'
-        ext = '.svg'
-    elif args.fmt == FMT_PDF:
-        data = svg2pdf(svg)
-        mode = 'b'
-        ext = '.pdf'
-    elif args.fmt == FMT_PNG:
-        data = svg2png(svg, svg_width, svg_height, args.raster_scale)
-        mode = 'b'
-        ext = '.png'
-    elif args.fmt == FMT_GIF_ANIM:
-        data = None
-        mode = None
-        ext = None
 
-        if anim_name is None:
-            anim_name = levelfile
-        anim_data.append(svg2png(svg, svg_width, svg_height, args.raster_scale))
-    else:
-        raise RuntimeError('unknown format for output: %s' % args.fmt)
 
-    if args.montage is not None:
-        # Reset for next svg.
-        inner_svg = ''
-        svg_width = args.padding
-        svg_height = args.padding
-        offset_x = args.padding
-        offset_y = args.padding
+frame_cache = None
+if args.watch and len(anim_fmts) > 0 and args.montage is None and FMT_LVLB not in args.fmt:
+    frame_cache = {}
 
-    if args.fmt != FMT_GIF_ANIM:
-        if args.stdout:
-            sys.stdout.write(data)
+stats = level_file_stats(args.levelfiles)
+render(expand_level_files(args.levelfiles), frame_cache)
 
-        else:
-            outfilename = new_file_name(levelfile, args.outfolder, args.suffix + ext)
-            print(' - writing', outfilename)
-            outfile = open(outfilename, 'w' + mode)
-            outfile.write(data)
-
-if args.fmt == FMT_GIF_ANIM:
-    outfilename = new_file_name(anim_name, args.outfolder, args.suffix + '.anim.gif')
-    print(' - writing', outfilename)
-    imgs = [PIL.Image.open(io.BytesIO(data)) for data in anim_data]
-
-    # put all the images into one image to find a good palette
-    img_meta = PIL.Image.new('RGB', (imgs[0].width, imgs[0].height * len(imgs)))
-    for ii, img in enumerate(imgs):
-        img_meta.paste(img, (0, imgs[0].height * ii))
-    img_meta = img_meta.quantize(colors=256, dither=0)
-    imgs = [img.quantize(palette=img_meta, dither=0) for img in imgs]
-
-    # disposal=2 prevents removal of duplicate frames
-    imgs[0].save(fp=outfilename, append_images=imgs[1:], save_all=True, duration=args.anim_delay, loop=0, optimize=False, disposal=2)
+if args.watch:
+    watch_levels(stats, frame_cache)